@@ -17,11 +17,15 @@
 # END.
 
 import base64
+import concurrent.futures
 import copy
 import os
 import platform
+import shutil
 import subprocess
+import stat
 import sys
+import tempfile
 import unittest
 from os.path import dirname
 
@@ -98,6 +102,107 @@ class TestHasCompileFlag(SetupConfigs):
     def test_multiple_flags(self):
         self.assertTrue(dsl.hasCompileFlag(self.config, '-O1 -Dhello'))
 
+    def test_flags_with_extra_whitespace(self):
+        self.assertTrue(dsl.hasCompileFlag(self.config, '  -O1   -Dhello '))
+        self.assertFalse(dsl.hasCompileFlag(self.config, ' -this_is_not_a_flag_any_compiler_has'))
+
+    def test_quoted_flag(self):
+        self.assertTrue(dsl.hasCompileFlag(self.config, "'-DFOO=a b'"))
+
+    def test_unbalanced_quotes(self):
+        self.assertFalse(dsl.hasCompileFlag(self.config, "-DX='"))
+
+
+class TestPersistentCaches(SetupConfigs):
+    """
+    Tests for the caching of probes across Lit invocations.
+    """
+    def setUp(self):
+        # Use a compiler wrapper that records each probe it runs, and invoke it
+        # through `env` like the Darwin configuration does.
+        self.wrapperDir = tempfile.mkdtemp(dir=EXEC_PATH)
+        self.log = os.path.join(self.wrapperDir, 'log')
+        self.wrapper = os.path.join(self.wrapperDir, 'cxx')
+        with open(self.wrapper, 'w') as wrapper:
+            wrapper.write('#!/bin/sh\n'
+                          'case "$*" in *-verify*) ;; *) echo >> "{}" ;; esac\n'
+                          'exec {} "$@"\n'.format(self.log, base64.b64decode(CXX.encode()).decode()))
+        os.chmod(self.wrapper, os.stat(self.wrapper).st_mode | stat.S_IEXEC)
+        self.makeConfig()
+
+    def makeConfig(self):
+        super(TestPersistentCaches, self).setUp()
+        self.config.substitutions = [('%{cxx}', 'env FOO=bar ' + self.wrapper) if s == '%{cxx}' else (s, x)
+                                     for (s, x) in self.config.substitutions]
+
+    def probes(self):
+        if not os.path.exists(self.log):
+            return 0
+        with open(self.log, 'r') as log:
+            return len(log.readlines())
+
+    def startNewLitInvocation(self):
+        dsl._flushPersistentCaches()
+        dsl._persistentCaches.clear()
+        self.makeConfig()
+
+    def test_results_are_reused(self):
+        self.assertTrue(dsl.hasCompileFlag(self.config, '-O1'))
+        self.assertEqual(self.probes(), 1)
+        self.startNewLitInvocation()
+        self.assertTrue(dsl.hasCompileFlag(self.config, '-O1'))
+        self.assertEqual(self.probes(), 1)
+
+    def test_changed_compiler_is_not_reused(self):
+        self.assertTrue(dsl.hasCompileFlag(self.config, '-O1'))
+        self.assertEqual(self.probes(), 1)
+        self.startNewLitInvocation()
+        mtime = os.path.getmtime(self.wrapper) + 10
+        os.utime(self.wrapper, (mtime, mtime))
+        self.assertTrue(dsl.hasCompileFlag(self.config, '-O1'))
+        self.assertEqual(self.probes(), 2)
+
+    def test_changed_input_is_not_reused(self):
+        header = os.path.join(self.wrapperDir, 'config_site.h')
+        def writeHeader(contents, mtime):
+            with open(header, 'w') as f:
+                f.write(contents)
+            os.utime(header, (mtime, mtime))
+        writeHeader('#define CONFIG_SITE_FOO\n', 1000000000)
+        self.config.substitutions.append(('%{extra}', '-include {}'.format(header)))
+        self.assertIn('CONFIG_SITE_FOO', dsl.compilerMacros(self.config, '%{extra}'))
+        self.startNewLitInvocation()
+        self.config.substitutions.append(('%{extra}', '-include {}'.format(header)))
+        writeHeader('#define CONFIG_SITE_BAR\n', 1000000010)
+        macros = dsl.compilerMacros(self.config, '%{extra}')
+        self.assertNotIn('CONFIG_SITE_FOO', macros)
+        self.assertIn('CONFIG_SITE_BAR', macros)
+        self.assertEqual(self.probes(), 2)
+
+    def test_unwritable_cache_is_ignored(self):
+        self.config.test_exec_root = tempfile.mkdtemp(dir=self.wrapperDir)
+        self.assertTrue(dsl.hasCompileFlag(self.config, '-O1'))
+        shutil.rmtree(self.config.test_exec_root)
+        with open(self.config.test_exec_root, 'w'):
+            pass
+        dsl._flushPersistentCaches()
+
+    def test_feature_test_macros_share_the_macros_probe(self):
+        dsl.compilerMacros(self.config, '-O1')
+        dsl.featureTestMacros(self.config, '-O1')
+        self.assertEqual(self.probes(), 1)
+
+
+class TestHasStdFlag(SetupConfigs):
+    """
+    Tests for libcxx.test.dsl.hasStdFlag
+    """
+    def test_existing_standard(self):
+        self.assertTrue(dsl.hasStdFlag(self.config, 'c++11'))
+
+    def test_nonexistent_standard(self):
+        self.assertFalse(dsl.hasStdFlag(self.config, 'c++1000'))
+
 
 class TestHasLocale(SetupConfigs):
     """
@@ -114,6 +219,37 @@ class TestHasLocale(SetupConfigs):
     def test_nonexistent_locale(self):
         self.assertFalse(dsl.hasLocale(self.config, 'for_sure_this_is_not_an_existing_locale'))
 
+    def test_c_locale(self):
+        # The "C" locale is always available, and checking it after another
+        # locale makes sure the program used for checking locales is reused.
+        self.assertFalse(dsl.hasLocale(self.config, 'for_sure_this_is_not_an_existing_locale'))
+        self.assertTrue(dsl.hasLocale(self.config, 'C'))
+
+    def test_concurrent_checks(self):
+        # run.py creates and removes an execution directory based on %t for
+        # each run, so runs of the program checking locales can't overlap.
+        self.config.test_exec_root = tempfile.mkdtemp(dir=EXEC_PATH)
+        runPy = os.path.join(monorepoRoot, 'libcxx', 'utils', 'run.py')
+        self.config.substitutions = [(s, x) for (s, x) in self.config.substitutions if s != '%{exec}']
+        self.config.substitutions.append(('%{exec}', '{} {} --execdir %t.execdir --dependencies %{{file_dependencies}} -- '.format(sys.executable, runPy)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda locale: dsl.hasLocale(self.config, locale), ['C', 'POSIX'] * 8))
+        self.assertEqual(results, [True] * 16)
+
+    def test_executor_failure_is_not_remembered(self):
+        self.config.test_exec_root = tempfile.mkdtemp(dir=EXEC_PATH)
+        executor = os.path.join(self.config.test_exec_root, 'executor')
+        def writeExecutor(contents):
+            with open(executor, 'w') as f:
+                f.write('#!/bin/sh\n' + contents + '\n')
+            os.chmod(executor, os.stat(executor).st_mode | stat.S_IEXEC)
+        self.config.substitutions = [(s, x) for (s, x) in self.config.substitutions if s != '%{exec}']
+        self.config.substitutions.append(('%{exec}', executor))
+        writeExecutor('exit 1')
+        self.assertFalse(dsl.hasLocale(self.config, 'C'))
+        writeExecutor('exec "$@"')
+        self.assertTrue(dsl.hasLocale(self.config, 'C'))
+
 
 class TestCompilerMacros(SetupConfigs):
     """
@@ -146,6 +282,26 @@ class TestCompilerMacros(SetupConfigs):
         self.assertEqual(macros['FOO'], '3')
         self.assertEqual(macros['BAR'], 'hello')
 
+    def test_with_substitution_expanding_to_several_flags(self):
+        self.config.substitutions.append(('%{extra}', '-DA=1 -DB=2'))
+        macros = dsl.compilerMacros(self.config, '%{extra}')
+        self.assertEqual(macros['A'], '1')
+        self.assertEqual(macros['B'], '2')
+
+    def test_with_prefix(self):
+        macros = dsl.compilerMacros(self.config, '-DFOO=3 -DFOOBAR=hello -DBAR=4', prefix='FOO')
+        self.assertEqual(macros, {'FOO': '3', 'FOOBAR': 'hello'})
+
+    def test_with_prefix_matching_nothing(self):
+        macros = dsl.compilerMacros(self.config, prefix='__this_is_not_a_macro_prefix')
+        self.assertEqual(macros, {})
+
+    def test_with_prefix_is_a_subset(self):
+        allMacros = dsl.compilerMacros(self.config)
+        macros = dsl.compilerMacros(self.config, prefix='__cpp')
+        self.assertGreater(len(macros), 0)
+        self.assertEqual(macros, {m: v for (m, v) in allMacros.items() if m.startswith('__cpp')})
+
 
 class TestFeatureTestMacros(SetupConfigs):
     """
@@ -160,6 +316,88 @@ class TestFeatureTestMacros(SetupConfigs):
             self.assertIsInstance(v, int)
 
 
+class TestCachedConfig(SetupConfigs):
+    """
+    Tests for libcxx.test.dsl.{cachedConfigKey,loadCachedConfig,saveCachedConfig}
+    """
+    def test_roundtrip(self):
+        key = dsl.cachedConfigKey(self.config, self.litConfig.params)
+        dsl.Feature(name='name', compileFlag='-foo').enableIn(self.config)
+        self.assertTrue(dsl.saveCachedConfig(self.config, key))
+        resolvedSubstitutions = list(self.config.substitutions)
+
+        self.setUp()
+        self.assertEqual(key, dsl.cachedConfigKey(self.config, self.litConfig.params))
+        self.assertTrue(dsl.loadCachedConfig(self.config, key))
+        self.assertIn('name', self.config.available_features)
+        self.assertEqual(resolvedSubstitutions, list(self.config.substitutions))
+        self.assertIn('-foo', self.getSubstitution('%{compile_flags}'))
+
+    def test_key_changes_with_inputs(self):
+        key = dsl.cachedConfigKey(self.config, self.litConfig.params)
+        self.assertNotEqual(key, dsl.cachedConfigKey(self.config, {'std': 'c++03'}))
+        dsl.Feature(name='name', compileFlag='-foo').enableIn(self.config)
+        self.assertNotEqual(key, dsl.cachedConfigKey(self.config, self.litConfig.params))
+
+    def test_key_changes_with_included_files(self):
+        (fd, header) = tempfile.mkstemp(dir=EXEC_PATH)
+        os.close(fd)
+        self.config.substitutions.append(('%{extra}', '-include {}'.format(header)))
+        key = dsl.cachedConfigKey(self.config, self.litConfig.params)
+        mtime = os.path.getmtime(header) + 10
+        os.utime(header, (mtime, mtime))
+        self.assertNotEqual(key, dsl.cachedConfigKey(self.config, self.litConfig.params))
+
+    def test_mismatched_key(self):
+        dsl.Feature(name='name').enableIn(self.config)
+        self.assertTrue(dsl.saveCachedConfig(self.config, 'some-key'))
+        self.setUp()
+        self.assertFalse(dsl.loadCachedConfig(self.config, 'some-other-key'))
+        self.assertNotIn('name', self.config.available_features)
+
+
+class TestSubstitutionList(unittest.TestCase):
+    """
+    Tests for libcxx.test.dsl.SubstitutionList
+    """
+    def test_is_a_list(self):
+        subs = dsl.SubstitutionList([('%{a}', 'a'), ('%{b}', 'b')])
+        self.assertIsInstance(subs, list)
+        self.assertEqual(subs, [('%{a}', 'a'), ('%{b}', 'b')])
+
+    def test_get(self):
+        subs = dsl.SubstitutionList([('%{a}', 'a'), ('%{b}', 'b')])
+        self.assertEqual(subs.get('%{b}'), 'b')
+        self.assertIsNone(subs.get('%{c}'))
+        self.assertEqual(subs.get('%{c}', ''), '')
+
+    def test_first_substitution_wins(self):
+        subs = dsl.SubstitutionList([('%{a}', 'first'), ('%{a}', 'second')])
+        self.assertEqual(subs.get('%{a}'), 'first')
+        subs.set('%{a}', 'replaced')
+        self.assertEqual(subs, [('%{a}', 'replaced'), ('%{a}', 'second')])
+
+    def test_set(self):
+        subs = dsl.SubstitutionList([('%{a}', 'a'), ('%{b}', 'b')])
+        subs.set('%{b}', 'c')
+        self.assertEqual(subs, [('%{a}', 'a'), ('%{b}', 'c')])
+        self.assertRaises(KeyError, lambda: subs.set('%{c}', 'c'))
+
+    def test_lookups_see_modifications(self):
+        subs = dsl.SubstitutionList([('%{a}', 'a')])
+        self.assertIsNone(subs.get('%{b}'))
+        subs.insert(0, ('%{b}', 'b'))
+        self.assertEqual(subs.get('%{b}'), 'b')
+        subs += [('%{c}', 'c')]
+        self.assertIsInstance(subs, dsl.SubstitutionList)
+        self.assertEqual(subs.get('%{c}'), 'c')
+        subs[0] = ('%{b}', 'bb')
+        self.assertEqual(subs.get('%{b}'), 'bb')
+        del subs[0]
+        self.assertIsNone(subs.get('%{b}'))
+        self.assertEqual(subs.get('%{a}'), 'a')
+
+
 class TestFeature(SetupConfigs):
     """
     Tests for libcxx.test.dsl.Feature
@@ -196,6 +434,14 @@ class TestFeature(SetupConfigs):
         self.assertIn('-foo', self.getSubstitution('%{link_flags}'))
         self.assertEqual(origCompileFlags, self.getSubstitution('%{compile_flags}'))
 
+    def test_substitutions_remain_a_list(self):
+        feature = dsl.Feature(name='name', compileFlag='-foo', when=lambda cfg: dsl.hasCompileFlag(cfg, '-O1'))
+        assert feature.isSupported(self.config)
+        feature.enableIn(self.config)
+        self.assertIsInstance(self.config.substitutions, list)
+        self.config.substitutions.insert(0, ('%{foo}', 'foo'))
+        self.config.substitutions += [('%{bar}', 'bar')]
+
     def test_adding_both_flags(self):
         feature = dsl.Feature(name='name', compileFlag='-hello', linkFlag='-world')
         assert feature.isSupported(self.config)
@@ -219,6 +465,29 @@ class TestFeature(SetupConfigs):
         self.assertTrue(feature.isSupported(self.config))
 
 
+class TestEnableFeatures(SetupConfigs):
+    """
+    Tests for libcxx.test.dsl.enableFeatures
+    """
+    def test_no_features(self):
+        self.assertEqual(dsl.enableFeatures(self.config, []), [])
+
+    def test_only_supported_features_are_enabled(self):
+        features = [
+            dsl.Feature(name='supported-1', compileFlag='-foo'),
+            dsl.Feature(name='unsupported', compileFlag='-bar', when=lambda _: False),
+            dsl.Feature(name='supported-2', linkFlag='-baz', when=lambda cfg: dsl.hasCompileFlag(cfg, '-O1')),
+        ]
+        enabled = dsl.enableFeatures(self.config, features)
+        self.assertEqual(enabled, [features[0], features[2]])
+        self.assertIn('supported-1', self.config.available_features)
+        self.assertIn('supported-2', self.config.available_features)
+        self.assertNotIn('unsupported', self.config.available_features)
+        self.assertIn('-foo', self.getSubstitution('%{compile_flags}'))
+        self.assertNotIn('-bar', self.getSubstitution('%{compile_flags}'))
+        self.assertIn('-baz', self.getSubstitution('%{link_flags}'))
+
+
 class TestParameter(SetupConfigs):
     """
     Tests for libcxx.test.dsl.Parameter
@@ -291,6 +560,12 @@ class TestParameter(SetupConfigs):
         param.getFeature(self.config, self.litConfig.params).enableIn(self.config)
         self.assertIn('-fno-exceptions', self.config.available_features)
 
+    def test_boolean_value_parsed_from_invalid_string_parameter(self):
+        self.litConfig.params['enable_exceptions'] = "maybe"
+        param = dsl.Parameter(name='enable_exceptions', choices=[True, False], type=bool, help='',
+                              feature=lambda exceptions: None)
+        self.assertRaises(ValueError, lambda: param.getFeature(self.config, self.litConfig.params))
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
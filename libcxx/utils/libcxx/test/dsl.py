@@ -6,45 +6,255 @@
 #
 #===----------------------------------------------------------------------===##
 
-import distutils.util
-import libcxx.test.newformat
-import lit
-import lit.util
+import atexit
+import collections
+import hashlib
+import json
 import os
-import pipes
+import pickle
+import re
+import shlex
 import subprocess
 import tempfile
+import threading
+import zlib
+
+_MACRO_RE = re.compile(br'^#define (\S+)(?: (.*?))?\s*$', re.M)
+
+# Note that `lit`, `libcxx.test.newformat` and `concurrent.futures` are imported
+# lazily by the functions that need them, since importing them is expensive and
+# not needed by users of this module that only define Features and Parameters.
+
+def _commandWords(command):
+  # Split a command into its arguments, in order to inspect them. On Windows,
+  # splitting on whitespace is good enough for that.
+  return shlex.split(command) if os.name != 'nt' else command.split()
+
+def _compilerPath(config):
+  import lit.util
+  cxx = _substitutionList(config).get('%{cxx}', '')
+  words = _commandWords(cxx)
+  # %{cxx} may run the compiler through `env`, e.g. `env DYLD_LIBRARY_PATH="" clang++`
+  # on Darwin, in which case the compiler is the first word after the options
+  # and variable assignments of `env`.
+  if words and os.path.basename(words[0]) == 'env':
+    words = words[1:]
+    while words and (words[0].startswith('-') or '=' in words[0]):
+      words = words[1:]
+  compiler = lit.util.which(words[0]) if words else None
+  return os.path.realpath(compiler) if compiler else None
+
+def _compilerTimestamp(config):
+  compiler = _compilerPath(config)
+  return str(os.path.getmtime(compiler)) if compiler else ''
+
+def _inputTimestamps(command):
+  # Return the modification times of the existing files among the arguments of
+  # a command (except its output, after `-o`), such as the __config_site header
+  # that %{compile_flags} includes, since the result of the command depends on
+  # them.
+  try:
+    words = _commandWords(command)
+  except ValueError:
+    return ''
+  inputs = [w for (i, w) in enumerate(words) if (i == 0 or words[i - 1] != '-o') and os.path.isfile(w)]
+  return repr([(f, os.path.getmtime(f)) for f in inputs])
+
+# Bump this whenever the format of the values stored in the persistent caches
+# changes, so that values stored by a previous version are not reused.
+_PERSISTENT_CACHE_VERSION = '4'
+
+# The maximum number of entries kept in each persistent cache. The least
+# recently used entries are evicted first, so that the caches don't grow
+# without bound as the compiler or the flags change.
+_PERSISTENT_CACHE_SIZE = 1024
+
+# Persistent caches are loaded from disk the first time they are used, and
+# written back to disk once, when Lit exits. They are keyed on the path of
+# the file backing them.
+_persistentCaches = dict()
+_dirtyPersistentCaches = set()
+_persistentCachesLock = threading.Lock()
+
+def _loadPersistentCache(path):
+  try:
+    with open(path, 'rb') as f:
+      return collections.OrderedDict(pickle.load(f))
+  except Exception:
+    return collections.OrderedDict()
+
+def _storePersistentCache(path, cache):
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  tmp = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False)
+  with tmp:
+    pickle.dump(cache, tmp, protocol=pickle.HIGHEST_PROTOCOL)
+  os.replace(tmp.name, path)
+
+@atexit.register
+def _flushPersistentCaches():
+  with _persistentCachesLock:
+    for path in _dirtyPersistentCaches:
+      try:
+        _storePersistentCache(path, _persistentCaches[path])
+      except OSError:
+        pass # The results are simply computed again by the next Lit invocation.
+    _dirtyPersistentCaches.clear()
+
+def _persistentCachePath(config, cacheName):
+  path = os.path.join(config.test_exec_root, '.dsl_cache', cacheName)
+  with _persistentCachesLock:
+    if path not in _persistentCaches:
+      _persistentCaches[path] = _loadPersistentCache(path)
+  return path
+
+def _persistentCacheKey(config, *parts):
+  # Entries are also keyed on the modification time of the compiler in the
+  # %{cxx} substitution, so that updating the compiler invalidates the results
+  # obtained with the previous one.
+  key = '\0'.join(parts + (_compilerTimestamp(config), _PERSISTENT_CACHE_VERSION))
+  return hashlib.sha1(key.encode()).hexdigest()
+
+def _lookupPersistentCache(config, cacheName, key):
+  path = _persistentCachePath(config, cacheName)
+  with _persistentCachesLock:
+    cache = _persistentCaches[path]
+    if key not in cache:
+      return (False, None)
+    cache.move_to_end(key)
+    return (True, cache[key])
+
+def _updatePersistentCache(config, cacheName, key, value):
+  path = _persistentCachePath(config, cacheName)
+  with _persistentCachesLock:
+    cache = _persistentCaches[path]
+    cache[key] = value
+    while len(cache) > _PERSISTENT_CACHE_SIZE:
+      cache.popitem(last=False)
+    _dirtyPersistentCaches.add(path)
+
+def _persistentMemoize(cacheName):
+  """
+  Memoize a function of a TestingConfig and of one or more commands, both in
+  memory and on disk inside the test execution root, so that results are
+  reused across Lit invocations. The results are invalidated when the files
+  read by the commands change.
+  """
+  def decorator(f):
+    def memoized(config, *commands):
+      key = _persistentCacheKey(config, *[p for c in commands for p in (c, _inputTimestamps(c))])
+      (found, result) = _lookupPersistentCache(config, cacheName, key)
+      if not found:
+        result = f(config, *commands)
+        _updatePersistentCache(config, cacheName, key, result)
+      return result
+    return memoized
+  return decorator
+
+# Commands are run directly instead of through a shell, which saves spawning
+# a shell for every probe. On Windows, the command line is passed as-is since
+# that is how processes receive their arguments there anyway.
+def _splitCommand(command):
+  return command if os.name == 'nt' else shlex.split(command)
 
-def _memoize(f):
-  cache = dict()
-  def memoized(x):
-    if x not in cache:
-      cache[x] = f(x)
-    return cache[x]
-  return memoized
-
-@_memoize
 def _subprocess_call(command):
-  devNull = open(os.devnull, 'w')
-  return subprocess.call(command, shell=True, stdout=devNull, stderr=devNull)
-
-@_memoize
-def _subprocess_check_output(command):
-  devNull = open(os.devnull, 'w')
-  return lit.util.to_string(subprocess.check_output(command, shell=True, stderr=devNull))
-
-def _makeConfigTest(config):
+  try:
+    return subprocess.call(_splitCommand(command), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  except (OSError, ValueError): # ValueError is raised for unbalanced quotes
+    return 127
+
+def _subprocess_run(command):
+  try:
+    process = subprocess.Popen(_splitCommand(command), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+  except (OSError, ValueError): # ValueError is raised for unbalanced quotes
+    return (127, b'')
+  (stdout, _) = process.communicate()
+  return (process.returncode, stdout)
+
+_configCachesLock = threading.Lock()
+
+def _configCache(config, name):
+  with _configCachesLock:
+    if not hasattr(config, name):
+      setattr(config, name, dict())
+    return getattr(config, name)
+
+def _substitutionList(config):
+  with _configCachesLock:
+    if not isinstance(config.substitutions, SubstitutionList):
+      config.substitutions = SubstitutionList(config.substitutions)
+    return config.substitutions
+
+def _makeConfigTest(config, name='empty.cpp', source=''):
+  # Each kind of probe uses a test file with a stable name and contents, which
+  # avoids creating and deleting files for every probe and makes the commands
+  # (which may refer to %s or %t) identical across probes, which is better for
+  # memoization.
+  import lit.Test
   sourceRoot = os.path.join(config.test_exec_root, '__config_src__')
   execRoot = os.path.join(config.test_exec_root, '__config_exec__')
   suite = lit.Test.TestSuite('__config__', sourceRoot, execRoot, config)
-  if not os.path.exists(sourceRoot):
-    os.makedirs(sourceRoot)
-  tmp = tempfile.NamedTemporaryFile(dir=sourceRoot, delete=False)
-  pathInSuite = [os.path.relpath(tmp.name, sourceRoot)]
+  # The file is only written the first time it is used with a TestingConfig.
+  # It is left untouched if it already has the right contents, so that its
+  # modification time only changes when its contents do.
+  written = _configCache(config, '_configTestSources')
+  if written.get(name) != source:
+    os.makedirs(sourceRoot, exist_ok=True)
+    _writeIfChanged(os.path.join(sourceRoot, name), source)
+    written[name] = source
   class TestWrapper(lit.Test.Test):
     def __enter__(self):       return self
-    def __exit__(self, *args): os.remove(tmp.name)
-  return TestWrapper(suite, pathInSuite, config)
+    def __exit__(self, *args): pass
+  return TestWrapper(suite, [name], config)
+
+def _writeIfChanged(path, contents):
+  try:
+    with open(path, 'r') as f:
+      if f.read() == contents:
+        return
+  except IOError:
+    pass
+  tmp = tempfile.NamedTemporaryFile(mode='w', dir=os.path.dirname(path), delete=False)
+  with tmp:
+    tmp.write(contents)
+  os.replace(tmp.name, path)
+
+def _parseScript(test, preamble, fileDependencies):
+  # Parsing the script of a probe is memoized on the TestingConfig, since it
+  # only depends on the (stable) test file and on the substitutions.
+  import libcxx.test.newformat
+  config = test.config
+  cache = _configCache(config, '_parseScriptCache')
+  key = (test.getSourcePath(), tuple(config.substitutions), config.recursiveExpansionLimit,
+         tuple(preamble), tuple(fileDependencies))
+  if key not in cache:
+    cache[key] = libcxx.test.newformat.parseScript(test, preamble=preamble, fileDependencies=fileDependencies)
+  return list(cache[key])
+
+def _canonicalCommand(command):
+  # Spell commands that run the same arguments the same way (e.g. with
+  # ' -std=c++17' and '-std=c++17'), so that they share the same probe. This
+  # is done after substitution, since a single substitution may expand to
+  # several arguments.
+  if os.name == 'nt':
+    return command.strip()
+  try:
+    return ' '.join(shlex.quote(arg) for arg in shlex.split(command))
+  except ValueError:
+    return command # The command has unbalanced quotes, so running it fails anyway
+
+def _compilerCommand(config, command):
+  with _makeConfigTest(config) as test:
+    return _canonicalCommand(_parseScript(test, preamble=[command], fileDependencies=[])[0])
+
+@_persistentMemoize('compile_flags')
+def _compileFlagProbe(config, command):
+  return _subprocess_call(command) == 0
+
+@_persistentMemoize('compiler_macros')
+def _compilerMacrosProbe(config, command):
+  (returncode, stdout) = _subprocess_run(command)
+  # The dump of macros is large, but it compresses very well.
+  return (returncode, zlib.compress(stdout))
 
 def hasCompileFlag(config, flag):
   """
@@ -53,11 +263,26 @@ def hasCompileFlag(config, flag):
   This is done by executing the %{cxx} substitution with the given flag and
   checking whether that succeeds.
   """
-  with _makeConfigTest(config) as test:
-    command = "%{{cxx}} -xc++ {} -Werror -fsyntax-only %{{flags}} %{{compile_flags}} {}".format(os.devnull, flag)
-    command = libcxx.test.newformat.parseScript(test, preamble=[command], fileDependencies=[])[0]
-    result = _subprocess_call(command)
-    return result == 0
+  command = "%{{cxx}} -xc++ {} -Werror -fsyntax-only %{{flags}} %{{compile_flags}} {}".format(os.devnull, flag)
+  command = _compilerCommand(config, command)
+  cache = _configCache(config, '_compileFlagCache')
+  if command not in cache:
+    cache[command] = _compileFlagProbe(config, command)
+  return cache[command]
+
+def hasStdFlag(config, std):
+  """
+  Return whether the compiler in the configuration supports a given language
+  standard, such as 'c++17', through the `-std=` flag.
+
+  This is the same as `hasCompileFlag(config, '-std=' + std)`, but it makes
+  sure that all the Features that depend on the same standard share a single
+  compiler probe.
+  """
+  return hasCompileFlag(config, '-std={}'.format(std))
+
+# Printed by the program used by hasLocale when it fails to set a locale.
+_LOCALE_UNSUPPORTED = 'libcxx-dsl: unsupported locale'
 
 def hasLocale(config, locale):
   """
@@ -67,27 +292,58 @@ def hasLocale(config, locale):
   %{exec} -- this means that the command may be executed on a remote host
   depending on the %{exec} substitution.
   """
-  with _makeConfigTest(config) as test:
-    with open(test.getSourcePath(), 'w') as source:
-      source.write("""
-      #include <locale.h>
-      int main(int, char** argv) {{
-        if (::setlocale(LC_ALL, argv[1]) != NULL) return 0;
-        else                                      return 1;
-      }}
-      """)
+  source = """
+    #include <locale.h>
+    #include <stdio.h>
+    int main(int, char** argv) {
+      if (::setlocale(LC_ALL, argv[1]) != NULL) return 0;
+      ::puts("%s");
+      return 1;
+    }
+    """ % _LOCALE_UNSUPPORTED
+  import lit.TestRunner
+  with _makeConfigTest(config, 'locale_probe.cpp', source) as test:
     commands = [
-      "mkdir -p %T",
       "%{cxx} -xc++ %s %{flags} %{compile_flags} %{link_flags} -o %t.exe",
-      "%{{exec}} %t.exe {}".format(pipes.quote(locale)),
+      "%{{exec}} %t.exe {}".format(shlex.quote(locale)),
     ]
-    commands = libcxx.test.newformat.parseScript(test, preamble=commands, fileDependencies=['%t.exe'])
-    result = _subprocess_call(' && '.join(commands))
-    cleanup = libcxx.test.newformat.parseScript(test, preamble=['rm %t.exe'], fileDependencies=[])[0]
-    _subprocess_call(cleanup)
-    return result == 0
-
-def compilerMacros(config, flags=''):
+    (build, run) = _parseScript(test, preamble=commands, fileDependencies=['%t.exe'])
+    (tmpDir, _) = lit.TestRunner.getTempPaths(test)
+
+  # Only the files read by `build` are taken into account: the program that
+  # `run` refers to is rebuilt by every Lit invocation.
+  key = _persistentCacheKey(config, build, _inputTimestamps(build), run)
+  (found, supported) = _lookupPersistentCache(config, 'locale_probe', key)
+  if not found:
+    (supported, conclusive) = _runLocaleProbe(config, tmpDir, build, run)
+    # A locale is only remembered as unsupported when the program itself said
+    # so, since the program may also fail to build or to run (e.g. when a
+    # remote host can't be reached), which says nothing about the locale.
+    if supported or conclusive:
+      _updatePersistentCache(config, 'locale_probe', key, supported)
+  return supported
+
+_localeProbeLock = threading.Lock()
+
+def _runLocaleProbe(config, tmpDir, build, run):
+  # The program used to check locales is only built once for each build
+  # command, and then reused to check all the locales. Checks using the same
+  # program are serialized, since %{exec} may run it in a directory derived
+  # from its path (like `%t.execdir`), which can't be shared by several runs.
+  # Returns a tuple (supported, conclusive).
+  builds = _configCache(config, '_localeProbeBuilds')
+  with _localeProbeLock:
+    if build not in builds:
+      os.makedirs(tmpDir, exist_ok=True)
+      builds[build] = (_subprocess_call(build) == 0, threading.Lock())
+  (built, runLock) = builds[build]
+  if not built:
+    return (False, False)
+  with runLock:
+    (returncode, stdout) = _subprocess_run(run)
+  return (returncode == 0, _LOCALE_UNSUPPORTED.encode() in stdout)
+
+def compilerMacros(config, flags='', prefix=None):
   """
   Return a dictionary of predefined compiler macros.
 
@@ -96,18 +352,25 @@ def compilerMacros(config, flags=''):
 
   If the optional `flags` argument (a string) is provided, these flags will
   be added to the compiler invocation when generating the macros.
+
+  If the optional `prefix` argument (a string) is provided, only the macros
+  whose name starts with that prefix are returned. This is cheaper than
+  filtering the resulting dictionary, since other macros are not parsed.
   """
-  with _makeConfigTest(config) as test:
-    command = "%{{cxx}} -xc++ {} -dM -E %{{flags}} %{{compile_flags}} {}".format(os.devnull, flags)
-    command = libcxx.test.newformat.parseScript(test, preamble=[command], fileDependencies=[])[0]
-    unparsed = _subprocess_check_output(command)
-    parsedMacros = dict()
-    for line in filter(None, map(str.strip, unparsed.split('\n'))):
-      assert line.startswith('#define ')
-      line = line[len('#define '):]
-      macro, _, value = line.partition(' ')
-      parsedMacros[macro] = value
-    return parsedMacros
+  command = "%{{cxx}} -xc++ {} -dM -E %{{flags}} %{{compile_flags}} {}".format(os.devnull, flags)
+  command = _compilerCommand(config, command)
+  (returncode, unparsed) = _compilerMacrosProbe(config, command)
+  if returncode != 0:
+    raise subprocess.CalledProcessError(returncode, command)
+  # The output is scanned as bytes, and only the macros we keep are decoded.
+  unparsed = zlib.decompress(unparsed)
+  if prefix is None:
+    regex = _MACRO_RE
+  elif prefix.encode() not in unparsed:
+    return dict()
+  else:
+    regex = re.compile(br'^#define (' + re.escape(prefix.encode()) + br'\S*)(?: (.*?))?\s*$', re.M)
+  return {m.group(1).decode(): (m.group(2) or b'').decode() for m in regex.finditer(unparsed)}
 
 def featureTestMacros(config, flags=''):
   """
@@ -116,8 +379,163 @@ def featureTestMacros(config, flags=''):
   The keys are strings representing feature test macros, and the values are
   integers representing the value of the macro.
   """
-  allMacros = compilerMacros(config, flags)
-  return {m: int(v.rstrip('LlUu')) for (m, v) in allMacros.items() if m.startswith('__cpp_')}
+  allMacros = compilerMacros(config, flags, prefix='__cpp_')
+  return {m: int(v.rstrip('LlUu')) for (m, v) in allMacros.items()}
+
+
+class SubstitutionList(list):
+  """
+  Represents the substitutions of a TestingConfig, i.e. a list of (name, value)
+  pairs, in which the value of a substitution can also be looked up and
+  replaced by name in constant time.
+
+  A SubstitutionList is a list, so it can be used and modified like the list
+  of substitutions Lit creates. The position of each name in the list is
+  computed when it is first needed, and forgotten whenever the list is
+  modified. The DSL converts the substitutions of a TestingConfig to a
+  SubstitutionList when it needs to look up or modify them by name.
+
+  Like Lit, only the first substitution with a given name is considered.
+  """
+  def __init__(self, substitutions=()):
+    super(SubstitutionList, self).__init__(substitutions)
+    self._positions = None
+
+  def _position(self, name):
+    if self._positions is None:
+      positions = dict()
+      for (i, (s, _)) in enumerate(self):
+        positions.setdefault(s, i)
+      self._positions = positions
+    return self._positions.get(name)
+
+  def get(self, name, default=None):
+    """
+    Return the value of the substitution with the given name, or `default` if
+    there is no such substitution.
+    """
+    i = self._position(name)
+    return default if i is None else self[i][1]
+
+  def set(self, name, value):
+    """
+    Replace the value of the substitution with the given name. It is an error
+    if there is no such substitution.
+    """
+    i = self._position(name)
+    if i is None:
+      raise KeyError(name)
+    list.__setitem__(self, i, (name, value))
+
+def _forgettingPositions(method):
+  def wrapper(self, *args, **kwargs):
+    self._positions = None
+    return method(self, *args, **kwargs)
+  return wrapper
+
+for _method in ('__setitem__', '__delitem__', '__iadd__', '__imul__', 'append', 'extend',
+                'insert', 'pop', 'remove', 'clear', 'sort', 'reverse'):
+  setattr(SubstitutionList, _method, _forgettingPositions(getattr(list, _method)))
+del _method
+
+
+def enableFeatures(config, features):
+  """
+  Enable all the supported Features among `features` in a TestingConfig.
+
+  Whether each Feature is supported is determined concurrently, since this
+  usually involves running the compiler and the checks are independent from
+  each other. The supported Features are then enabled in the order in which
+  they were given. Returns the list of Features that were enabled.
+
+  Note that all the Features are checked against the TestingConfig as it is
+  before any of them is enabled, so whether a Feature is supported must not
+  depend on the other Features being enabled. This also means that the `when`
+  callables of the Features must be safe to call from several threads.
+  """
+  import concurrent.futures
+  features = list(features)
+  with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+    supported = list(executor.map(lambda f: f.isSupported(config), features))
+  enabled = [f for (f, isSupported) in zip(features, supported) if isSupported]
+  for feature in enabled:
+    feature._enableIn(config)
+  return enabled
+
+
+def cachedConfigKey(config, litParams, files=()):
+  """
+  Return a key identifying everything that the result of enabling Features and
+  Parameters in a TestingConfig depends on, for use with `loadCachedConfig`
+  and `saveCachedConfig`.
+
+  The key covers the compiler in the %{cxx} substitution (through its
+  modification time), the substitutions and available features of `config`
+  as they are before any Feature is enabled, the files that the substitutions
+  refer to (like the __config_site header in %{compile_flags}), the Lit
+  parameters `litParams`, and the modification times of the DSL itself and
+  of the given `files`. The
+  `files` should contain the lit.cfg that defines the Features and Parameters,
+  so that changing them invalidates the cached configuration.
+  """
+  files = [__file__, os.path.join(os.path.dirname(__file__), 'newformat.py')] + list(files)
+  key = [
+    _compilerTimestamp(config),
+    repr(list(config.substitutions)),
+    repr([_inputTimestamps(x) for (_, x) in config.substitutions]),
+    repr(sorted(config.available_features)),
+    repr(sorted((k, str(v)) for (k, v) in litParams.items())),
+    repr([(f, os.path.getmtime(f)) for f in files])
+  ]
+  return hashlib.sha1('\0'.join(key).encode()).hexdigest()
+
+def _cachedConfigPath(config):
+  return os.path.join(config.test_exec_root, '.dsl_cache', 'config.json')
+
+def loadCachedConfig(config, key):
+  """
+  Restore the available features and substitutions of a TestingConfig from
+  the ones saved by `saveCachedConfig` with the same key.
+
+  Returns whether the configuration could be restored. If it could, there is
+  no need to check and enable Features or Parameters again, which avoids
+  running the compiler at all when nothing changed since the last time Lit
+  was run. Otherwise, `config` is left untouched.
+  """
+  try:
+    with open(_cachedConfigPath(config), 'r') as f:
+      cached = json.load(f)
+  except (IOError, ValueError):
+    return False
+  if cached.get('key') != key:
+    return False
+  config.available_features.clear()
+  config.available_features.update(cached['available_features'])
+  config.substitutions = [tuple(sub) for sub in cached['substitutions']]
+  return True
+
+def saveCachedConfig(config, key):
+  """
+  Save the available features and substitutions of a TestingConfig under the
+  given key, so that `loadCachedConfig` can restore them in a subsequent Lit
+  invocation.
+
+  Returns whether the configuration could be saved. This is not possible when
+  some substitutions can't be represented in JSON (e.g. substitutions using
+  regular expression captures), in which case nothing is saved.
+  """
+  try:
+    contents = json.dumps({
+      'key': key,
+      'available_features': sorted(config.available_features),
+      'substitutions': [[s, x] for (s, x) in config.substitutions]
+    }, indent=2)
+  except TypeError:
+    return False
+  path = _cachedConfigPath(config)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  _writeIfChanged(path, contents)
+  return True
 
 
 class Feature(object):
@@ -129,6 +547,8 @@ class Feature(object):
   control whether a Feature is enabled -- it should be enabled whenever it
   is supported.
   """
+  __slots__ = ('_name', '_compileFlag', '_linkFlag', '_isSupported')
+
   def __init__(self, name, compileFlag=None, linkFlag=None, when=lambda _: True):
     """
     Create a Lit feature for consumption by a test suite.
@@ -184,17 +604,37 @@ class Feature(object):
     """
     assert self.isSupported(config), \
       "Trying to enable feature {} that is not supported in the given configuration".format(self._name)
+    self._enableIn(config)
+
+  def _enableIn(self, config):
+    def addTo(subs, sub, flag):
+      value = subs.get(sub)
+      if value is not None:
+        subs.set(sub, value + ' ' + flag)
 
-    addTo = lambda subs, sub, flag: [(s, x + ' ' + flag) if s == sub else (s, x) for (s, x) in subs]
     if self._compileFlag:
-      config.substitutions = addTo(config.substitutions, '%{compile_flags}', self._compileFlag)
+      addTo(_substitutionList(config), '%{compile_flags}', self._compileFlag)
     if self._linkFlag:
-      config.substitutions = addTo(config.substitutions, '%{link_flags}', self._linkFlag)
+      addTo(_substitutionList(config), '%{link_flags}', self._linkFlag)
 
     name = self._name(config) if callable(self._name) else self._name
     config.available_features.add(name)
 
 
+_BOOLEAN_STRINGS = {
+  'y': True, 'yes': True, 't': True, 'true': True, 'on': True, '1': True,
+  'n': False, 'no': False, 'f': False, 'false': False, 'off': False, '0': False
+}
+
+def _parseBool(value):
+  if not isinstance(value, str):
+    return bool(value)
+  try:
+    return _BOOLEAN_STRINGS[value.lower()]
+  except KeyError:
+    raise ValueError("Invalid boolean value '{}'".format(value))
+
+
 class Parameter(object):
   """
   Represents a parameter of a Lit test suite.
@@ -221,6 +661,8 @@ class Parameter(object):
   compiler), it can be handled in the `lit.cfg`, but it shouldn't be
   represented with a Parameter.
   """
+  __slots__ = ('_name', '_choices', '_choicesSet', '_parse', '_help', '_feature', '_default')
+
   def __init__(self, name, choices, type, help, feature, default=None):
     """
     Create a Lit parameter to customize the behavior of a test suite.
@@ -232,9 +674,9 @@ class Parameter(object):
 
     - choices
         A non-empty set of possible values for this parameter. This must be
-        anything that can be iterated. It is an error if the parameter is
-        given a value that is not in that set, whether explicitly or through
-        a default value.
+        anything that can be iterated, and the values must be hashable. It is
+        an error if the parameter is given a value that is not in that set,
+        whether explicitly or through a default value.
 
     - type
         A callable that can be used to parse the value of the parameter given
@@ -261,12 +703,12 @@ class Parameter(object):
     if len(self._name) == 0:
       raise ValueError("Parameter name must not be the empty string")
 
-    self._choices = list(choices) # should be finite
+    self._choices = tuple(choices) # should be finite
+    self._choicesSet = frozenset(self._choices)
     if len(self._choices) == 0:
       raise ValueError("Parameter '{}' must be given at least one possible value".format(self._name))
 
-    self._parse = lambda x: (distutils.util.strtobool(x) if type is bool and isinstance(x, str)
-                                                         else type(x))
+    self._parse = _parseBool if type is bool else type
     self._help = help
     self._feature = feature
     self._default = default
@@ -287,6 +729,6 @@ class Parameter(object):
       raise ValueError("Parameter {} doesn't have a default value, but it was not specified in the Lit parameters".format(self.name))
     getDefault = lambda: self._default(config) if callable(self._default) else self._default
     value = self._parse(param) if param is not None else getDefault()
-    if value not in self._choices:
-      raise ValueError("Got value '{}' for parameter '{}', which is not in the provided set of possible choices: {}".format(value, self.name, self._choices))
+    if value not in self._choicesSet:
+      raise ValueError("Got value '{}' for parameter '{}', which is not in the provided set of possible choices: {}".format(value, self.name, list(self._choices)))
     return self._feature(value)
@@ -23,8 +23,7 @@ def _supportsVerify(test):
     command = "%{{cxx}} -xc++ {} -Werror -fsyntax-only -Xclang -verify-ignore-unexpected".format(os.devnull)
     command = lit.TestRunner.applySubstitutions([command], test.config.substitutions,
                                                 recursion_limit=test.config.recursiveExpansionLimit)[0]
-    devNull = open(os.devnull, 'w')
-    result = subprocess.call(command, shell=True, stdout=devNull, stderr=devNull)
+    result = subprocess.call(command, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     return result == 0
 
 def parseScript(test, preamble, fileDependencies):